@@ -12,12 +12,25 @@ import streamlit as st
 import streamlit.components.v1 as components  # <-- for autoscroll
 # from openai import OpenAI  # (moved into cached factory below)
 # from supabase import create_client, Client  # <-- lazy-import inside get_supabase()
-import json
 import re
 import base64
-from datetime import datetime, timezone
+import threading
+import uuid
 from pathlib import Path
 
+from contact_intent import IntentScorer
+from funnel_export import iter_supabase_chunks
+from prescreen_core import (
+    CONTACT_TOKEN,
+    PRESET_CRITERIA,
+    consume_stream,
+    contact_form_message,
+    handle_turn,
+    strip_machine_json,
+)
+from question_order import FailureStats, interview_order, plan_to_prompt
+from replay import RecordingStream
+
 # ---- Page config (must be first Streamlit call) ----
 st.set_page_config(
     page_title="trialmatches — Asthma Study Pre-Screen",
@@ -222,27 +235,15 @@ st.markdown(
 # 0) CONFIG: PRESET CRITERIA
 # =========================
 USE_PRESET_CRITERIA = True
-CONTACT_TOKEN = "[CONTACT_INFO_FORM]"  # sentinel the model outputs to trigger the form
-
-PRESET_CRITERIA = {
-    "title": "Combination Short-Acting BroNchodilator and Inhaled Corticosteroid Rescue Therapy on Health Outcomes in Routine Care | NCT06422689",
-    "inclusion": [
-        "1. Adults aged 18 years and above as of enrollment date.",
-	"2. At least 1 visit with primary or secondary diagnosis of asthma on or within 12 months prior to the enrollment date.",
-	"3. At least 1 prescription filled for Short-acting beta-agonist (SABA)-only inhaler (i.e., albuterol-only or levalbuterol only inhalers) within 12 months before enrollment date.",
-	"4. At least 1 asthma exacerbation within 12 months before enrollment date.",
-	"5. Had both medical and pharmacy insurance coverage (e.g., Medicare, Medicaid, and commercial insurance) for at least 12 months before enrollment date and without foreseeable plans to discontinue insurance coverage within 12 months after enrollment date.",
-	"6. Participants also need to meet each of the following inclusion criteria: 1. Willingness to use albuterol and budesonide as rescue as instructed by their physician, prescribing information, and United States instruction for use (USIFU). 2. Willingness to respond to quarterly safety inquiries. 3. Willingness to participate in quarterly electronic patient-reported outcome (PRO) surveys via email or text. 4. Physician decision that participant is eligible for treatment with albuterol and budesonide as rescue according to the approved United States prescribing information (USPI)."
-    ],
-    "exclusion": [
-        "1. Conditions with major respiratory diagnoses including chronic obstructive pulmonary disease (COPD), cystic fibrosis, pulmonary fibrosis, bronchiectasis, respiratory tract cancer, bronchopulmonary dysplasia, sarcoidosis, lung cancer, interstitial lung disease, pulmonary hypertension, and tuberculosis in 12 months before the enrollment date.",
-	"2. Inpatient admission or emergency department or urgent care visit due to asthma in the 10 days before enrollment date, or self-reported use of systemic corticosteroid for the treatment of asthma in the 10 days before enrollment date. Participants who were screen-failed due to this criterion may be re-screened once the participant is more than 10 days post asthma-related inpatient admission, emergency department or urgent care visit, or systemic corticosteroid use.",
-	"3. Chronic use of oral corticosteroids (for any condition) within 3 months before enrollment date. Chronic use of oral corticosteroids is defined as: daily or every other day use for 14 days or longer.",
-	"4. History of albuterol and budesonide as rescue use within 12 months before enrollment date.",
-	"5. History of any malignancy (except non-melanoma neoplasms of skin) in 12 months before the enrollment date.",
-	"6. For females only - currently pregnant or breastfeeding on enrollment date. Participants are excluded from the study if any of the following criteria apply."
-    ],
-}
+ASKED_IN_GREETING = ("inclusion 1",)  # age is asked by the static greeting
+STATS_MAX_ROWS = 20000  # most recent sessions the question-order stats are built from
+STATS_COLUMNS = "created_at,decision,rationale,asked_questions,answers,parsed_rules"
+
+# Output token budgets per phase. "interview" turns are usually one short question, but an
+# ineligible patient gets the summary + final JSON on an interview turn, so it must fit that too.
+MAX_OUTPUT_TOKENS = {"interview": 1200, "final": 2000}
+
+RECORD_DIR = os.environ.get("TM_RECORD_DIR")  # record streamed turns as replay fixtures
 
 def criteria_to_markdown(criteria: dict) -> str:
     inc = "\n".join(f"* {item}" for item in criteria.get("inclusion", []))
@@ -307,105 +308,77 @@ def get_supabase():
 
 client = get_openai_client()
 
-# =========================
-# 2) HELPERS
-# =========================
-def _as_bool(value) -> bool:
-    if isinstance(value, bool):
-        return value
-    if isinstance(value, (int, float)):
-        return value != 0
-    if isinstance(value, str):
-        return value.strip().lower() in {"yes", "y", "true", "t", "1", "consent", "agree", "agreed"}
-    return False
-
-def _normalize_decision(s: str) -> str:
-    s = (s or "").strip().lower()
-    if "likely ineligible" in s or "ineligible" in s:
-        return "Likely Ineligible"
-    if "likely eligible" in s:
-        return "Likely Eligible"
-    if s == "eligible" or ("eligible" in s and "likely" not in s and "ineligible" not in s):
-        return "Eligible"
-    if "unknown" in s:
-        return "Unknown"
-    return "Unknown"
-
-def extract_last_json_block(text: str):
+@st.cache_resource
+def get_stream_metrics():
     """
-    Parse the last JSON object from assistant reply.
-    Supports ```json ...``` fenced or raw {...}.
+    Process-wide counters for streamed completions (view with ?metrics=1).
+    output_tokens is what the API reported for streams that ran to the end; a stream cut short
+    (contact token or rerun/disconnect) never gets a usage chunk, so for those only the
+    content deltas received are known. errored (API / network failure mid-stream) is counted
+    apart from cancelled (Streamlit rerun / stop) and from cut_short.
     """
-    try:
-        blocks = re.findall(r"```(?:json)?\s*({[\s\S]*?})\s*```", text)
-        candidate = blocks[-1] if blocks else re.findall(r"({[\s\S]*})", text)[-1]
-        return json.loads(candidate)
-    except Exception:
-        return None
+    return {
+        "lock": threading.Lock(),
+        "counts": {
+            "streams": 0, "completed": 0, "length_capped": 0,
+            "stopped_on_contact_token": 0, "cancelled": 0, "errored": 0, "cut_short": 0,
+            "output_tokens": 0, "deltas_before_cut": 0,
+        },
+    }
 
-def strip_machine_json(text: str) -> str:
+def _record_stream(outcome: str, output_tokens, deltas: int):
+    m = get_stream_metrics()
+    with m["lock"]:
+        c = m["counts"]
+        c["streams"] += 1
+        c[outcome] += 1
+        if output_tokens is not None:
+            c["output_tokens"] += output_tokens
+        if outcome in ("stopped_on_contact_token", "cancelled"):
+            c["cut_short"] += 1
+            c["deltas_before_cut"] += deltas
+
+@st.cache_resource
+def get_failure_stats():
     """
-    Hide machine JSON & the contact token from user-visible content.
+    Per-criterion failure counts from the most recent STATS_MAX_ROWS persisted sessions;
+    shared by all sessions and updated in place by persist_result().
+    Loaded on a background thread so no page waits on the scan: until stats.ready,
+    new sessions get the listed order.
     """
-    t = re.sub(r"```(?:json)?\s*{[\s\S]*?}\s*```", "", text).strip()
-    t = re.sub(r"\s*{[\s\S]*}\s*$", "", t).strip()
-    t = t.replace(CONTACT_TOKEN, "").strip()
-    return t
+    stats = FailureStats()
+
+    def _load():
+        try:
+            stats.load(
+                iter_supabase_chunks(get_supabase(), 1000, columns=STATS_COLUMNS, newest_first=True),
+                max_rows=STATS_MAX_ROWS,
+            )
+        except Exception:
+            pass  # no history yet (or DB unreachable): keep whatever was folded in
+
+    threading.Thread(target=_load, name="failure-stats-load", daemon=True).start()
+    return stats
 
-def persist_result(reply_text: str, session_id: str = None):
+# =========================
+# 2) HELPERS
+# =========================
+def persist_result(payload: dict):
     """
-    Saves to Supabase on ANY decision.
-    Fields: created_at, trial_title, decision, rationale, asked_questions, answers,
-            parsed_rules, contact_email, contact_phone, consent, session_id
+    Saves to Supabase on ANY decision (row built by build_result_payload, via handle_turn).
     """
     sb = get_supabase()
-    data = extract_last_json_block(reply_text)
-
-    decision = "Unknown"
-    rationale = "No JSON payload found."
-    answers = None
-    parsed_rules = None
-    contact = {}
-    trial_title = None
-    questions = None
-
-    if data:
-        decision = _normalize_decision(data.get("decision"))
-        rationale = data.get("rationale")
-        answers = data.get("answers")
-        parsed_rules = data.get("parsed_rules")
-        contact = data.get("contact_info") or {}
-        trial_title = (parsed_rules or {}).get("trial_title")
-        questions = data.get("asked_questions")
-
-    consent_val = _as_bool(contact.get("consent"))
-    contact_email = contact.get("email")
-    contact_phone = contact.get("phone")
-
-    payload = {
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "trial_title": trial_title,
-        "decision": decision,
-        "rationale": rationale,
-        "asked_questions": questions,
-        "answers": answers,
-        "parsed_rules": parsed_rules,
-        "contact_email": contact_email,
-        "contact_phone": contact_phone,
-        "consent": consent_val,
-        "session_id": session_id,
-    }
 
     try:
         sb.table("prescreen_contacts").insert(payload).execute()
+        get_failure_stats().update(
+            payload["decision"], payload["rationale"], payload["asked_questions"],
+            payload["answers"], payload["parsed_rules"],
+        )
         return True, "Saved."
     except Exception as e:
         return False, f"DB error: {e}"
 
-def is_final_decision(reply_text: str) -> bool:
-    data = extract_last_json_block(reply_text)
-    return bool(isinstance(data, dict) and data.get("final") is True)
-
 def looks_like_phone(s: str) -> bool:
     """Basic phone validation: allow digits and common symbols, ensure 10–15 digits total."""
     digits = re.sub(r"\D", "", s or "")
@@ -417,40 +390,50 @@ def normalize_phone(s: str) -> str:
 def looks_like_email(s: str) -> bool:
     return bool(re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", s or ""))
 
-def should_trigger_contact_form(text: str) -> bool:
-    """
-    Robust trigger: token OR common phrasing asking for email/phone/consent.
-    """
-    if CONTACT_TOKEN in (text or ""):
-        return True
-    if re.search(r"\b(email|e-mail)\b", text or "", re.I) and re.search(r"\b(phone|number)\b", text or "", re.I):
-        return True
-    if re.search(r"\bconsent\b", text or "", re.I) and re.search(r"\bcontact(ed)?\b", text or "", re.I):
-        return True
-    return False
-
 # --- Streaming helper (streams assistant text while building full reply) ---
-def stream_openai_reply(messages):
+def stream_openai_reply(messages, phase: str = "interview"):
     """
-    Streams assistant content to the UI and returns the full raw reply string.
+    Streams assistant content to the UI and returns (full raw reply string, IntentScorer or None).
     Display hides any machine JSON or CONTACT token during streaming.
+    - Output capped at MAX_OUTPUT_TOKENS[phase]
+    - Interview turns stop as soon as CONTACT_TOKEN appears (the form can render right away).
+      Done client-side: an API stop sequence would drop the token from the reply.
+    - If Streamlit interrupts the run (rerun / disconnect raise out of placeholder.markdown),
+      consume_stream closes the stream so generation stops instead of running on unread.
+    - Interview turns are scored for contact hand-off intent as deltas arrive.
+    - With TM_RECORD_DIR set, each turn is also recorded as a replay fixture (see replay.py).
     """
+    budget = MAX_OUTPUT_TOKENS[phase]
     with st.chat_message("assistant"):
         placeholder = st.empty()
-        chunks = []
         stream = client.chat.completions.create(
             model="gpt-4o",
             messages=messages,
             temperature=0.4,
+            max_tokens=budget,
             stream=True,
+            stream_options={"include_usage": True},
         )
-        for event in stream:
-            delta = getattr(event.choices[0].delta, "content", None) or ""
-            if delta:
-                chunks.append(delta)
-                placeholder.markdown(strip_machine_json("".join(chunks)))
-        full = "".join(chunks).strip()
-    return full
+        if RECORD_DIR:
+            if "_record_id" not in st.session_state:
+                st.session_state._record_id = uuid.uuid4().hex[:12]
+            last_user = next((m for m in reversed(messages) if m["role"] == "user"), {})
+            stream = RecordingStream(
+                stream,
+                Path(RECORD_DIR) / f"{st.session_state._record_id}.json",
+                phase=phase,
+                user=None if last_user.get("hide") else last_user.get("content"),
+            )
+        intent = IntentScorer() if phase == "interview" else None
+        full = consume_stream(
+            stream,
+            on_text=lambda text: placeholder.markdown(strip_machine_json(text)),
+            stop_on_contact=(phase == "interview"),
+            on_done=_record_stream,
+            intent=intent,
+        ).strip()
+        placeholder.markdown(strip_machine_json(full))
+    return full, intent
 
 # --- Small helper to keep viewport pinned to the bottom ---
 def scroll_to_bottom():
@@ -465,6 +448,11 @@ def scroll_to_bottom():
 st.title("Check Your Eligibility for Local Asthma Studies")
 st.markdown("Quickly pre-screen for a Asthma clinical trials ocurring in the Boston area. We will only contact you if you qualify. Feel free to ask any information about clinical trials.")
 
+if st.query_params.get("metrics"):
+    with st.sidebar:
+        st.caption("Streamed completions")
+        st.json(dict(get_stream_metrics()["counts"]))
+
 # Session state
 if "messages" not in st.session_state:
     st.session_state.messages = []        # full history sent to model (seed hidden)
@@ -474,6 +462,13 @@ if "intake_complete" not in st.session_state:
     st.session_state.intake_complete = False
 if "awaiting_contact" not in st.session_state:
     st.session_state.awaiting_contact = False
+if "interview_plan" not in st.session_state:
+    # Frozen per session so the order can't shift mid-interview as stats update
+    _stats = get_failure_stats()
+    st.session_state.interview_plan = plan_to_prompt(
+        PRESET_CRITERIA,
+        interview_order(PRESET_CRITERIA, _stats if _stats.ready else FailureStats(), skip=ASKED_IN_GREETING),
+    )
 
 # =========================
 # 4) SYSTEM PROMPT
@@ -500,7 +495,7 @@ Pre-Screening Efficiency Rule
 
 Operating Loop
 1) Parse criteria silently.
-2) Plan interview silently. Pick top 3–5 questions only.
+2) Follow the Interview Plan below in order. Take the top 3–5 only.
 3) Immediately begin asking questions one at a time.
 4) Stop early if exclusion criteria are met.
 5) When you reach your final decision and the patient is Eligible/Likely Eligible, output the token {CONTACT_TOKEN} to trigger the form (no extra text needed if you prefer).
@@ -511,6 +506,14 @@ Operating Loop
    - Machine-readable JSON with keys:
      decision, rationale, asked_questions, answers, missing_info, parsed_rules,
      contact_info (email, phone, consent: true/false), final: true
+   - parsed_rules must include "criteria": one entry per criterion, e.g.
+     {{"id": "exclusion 3", "status": "met" | "not_met" | "unknown"}}
+     ("met" on an exclusion means the exclusion applies; "unknown" if it was not screened)
+
+Interview Plan (fixed; ordered by how often each criterion disqualifies patients)
+- Age (inclusion 1) was already asked in the greeting.
+- Screen the remaining criteria in this order, one question each:
+{st.session_state.interview_plan}
 
 JSON Formatting
 - Place the JSON in a single fenced block: ```json {{ ... }} ```
@@ -590,6 +593,50 @@ def render_contact_form():
             }
     return None
 
+def apply_turn(turn: dict):
+    """
+    Session-state / UI side of prescreen_core.handle_turn(): form flag, save notice, visible reply.
+    """
+    st.session_state.awaiting_contact = turn["show_form"]
+    if turn["payload"] is not None:
+        st.session_state.intake_complete = True
+        ok, msg = turn["saved"]
+        if ok:
+            st.toast("✅ Saved final decision + consent + answers to Supabase.")
+        else:
+            st.caption(f"Note: {msg}")
+    if turn["visible"]:
+        st.session_state.messages.append({"role": "assistant", "content": turn["visible"]})
+
+def submit_contact(contact: dict):
+    """
+    Hand the submitted form to the model, stream the final summary + JSON, persist the decision.
+    """
+    # Feed contact info to the model without showing a "sentence" bubble to the user
+    st.session_state.messages.append({
+        "role": "user",
+        "content": contact_form_message(contact),
+        "hide": True  # <-- keep out of visible history
+    })
+
+    # Visible, read-only snapshot of the form
+    st.session_state.messages.append({
+        "role": "assistant",
+        "type": "contact_snapshot",
+        "contact": contact,
+        "content": ""
+    })
+
+    raw_reply, _ = stream_openai_reply(
+        [{"role": "system", "content": system_prompt}] + st.session_state.messages,
+        phase="final",
+    )
+    apply_turn(handle_turn(
+        raw_reply, "final",
+        persist=persist_result,
+        session_id=st.session_state.get("_session_id"),
+    ))
+
 # If we were already waiting for contact info from a previous run/session, render the form now
 if st.session_state.awaiting_contact:
     with st.chat_message("assistant"):
@@ -598,48 +645,7 @@ if st.session_state.awaiting_contact:
     scroll_to_bottom()
 
     if contact:
-        # Feed contact info to the model without showing a "sentence" bubble to the user
-        contact_text = (
-            "Here is my contact information from the form:\n"
-            f"Email: {contact['email']}\n"
-            f"Phone: {contact['phone']}\n"
-            f"Consent: {'true' if contact['consent'] else 'false'}"
-        )
-        st.session_state.messages.append({
-            "role": "user",
-            "content": contact_text,
-            "hide": True  # <-- keep out of visible history
-        })
-
-        # Visible, read-only snapshot of the form
-        st.session_state.messages.append({
-            "role": "assistant",
-            "type": "contact_snapshot",
-            "contact": contact,
-            "content": ""
-        })
-
-        # Continue: produce final summary + JSON (hidden), then persist (streamed)
-        raw_reply = stream_openai_reply(
-            [{"role": "system", "content": system_prompt}] + st.session_state.messages
-        )
-
-        if is_final_decision(raw_reply):
-            st.session_state.intake_complete = True
-            ok, msg = persist_result(
-                reply_text=raw_reply,
-                session_id=st.session_state.get("_session_id")
-            )
-            if ok:
-                st.toast("✅ Saved final decision + consent + answers to Supabase.")
-            else:
-                st.caption(f"Note: {msg}")
-
-        display_reply = strip_machine_json(raw_reply)
-        if display_reply:
-            st.session_state.messages.append({"role": "assistant", "content": display_reply})
-
-        st.session_state.awaiting_contact = False
+        submit_contact(contact)
         # Stop here so we don't drop into chat_input and duplicate UI
         st.stop()
 
@@ -655,85 +661,28 @@ else:
         st.chat_message("user").markdown(user_text)
 
         # STREAM the assistant reply
-        raw_reply = stream_openai_reply(
+        raw_reply, intent = stream_openai_reply(
             [{"role": "system", "content": system_prompt}] + st.session_state.messages
         )
+        turn = handle_turn(
+            raw_reply, "interview", intent,
+            persist=persist_result,
+            session_id=st.session_state.get("_session_id"),
+        )
+        apply_turn(turn)
 
         # If the model signals the form, render it immediately (no rerun) and keep at bottom
-        if should_trigger_contact_form(raw_reply):
-            st.session_state.awaiting_contact = True
-
-            # Show a visible prompt if the model provided any, then the live form
-            visible = strip_machine_json(raw_reply).strip()
-            if not visible:
-                visible = "Great—you're likely a fit. Please complete the short contact form below."
-            st.session_state.messages.append({"role": "assistant", "content": visible})
-
+        if turn["show_form"]:
             with st.chat_message("assistant"):
                 contact = render_contact_form()
             scroll_to_bottom()
 
             if contact:
-                contact_text = (
-                    "Here is my contact information from the form:\n"
-                    f"Email: {contact['email']}\n"
-                    f"Phone: {contact['phone']}\n"
-                    f"Consent: {'true' if contact['consent'] else 'false'}"
-                )
-                st.session_state.messages.append({
-                    "role": "user",
-                    "content": contact_text,
-                    "hide": True
-                })
-
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "type": "contact_snapshot",
-                    "contact": contact,
-                    "content": ""
-                })
-
-                # Continue: produce final summary + JSON (hidden), then persist (streamed)
-                raw_reply2 = stream_openai_reply(
-                    [{"role": "system", "content": system_prompt}] + st.session_state.messages
-                )
-
-                if is_final_decision(raw_reply2):
-                    st.session_state.intake_complete = True
-                    ok, msg = persist_result(
-                        reply_text=raw_reply2,
-                        session_id=st.session_state.get("_session_id")
-                    )
-                    if ok:
-                        st.toast("✅ Saved final decision + consent + answers to Supabase.")
-                    else:
-                        st.caption(f"Note: {msg}")
-
-                display_reply2 = strip_machine_json(raw_reply2)
-                if display_reply2:
-                    st.session_state.messages.append({"role": "assistant", "content": display_reply2})
-
-                st.session_state.awaiting_contact = False
+                submit_contact(contact)
 
             # Always stop after handling the form path to avoid duplicate UI in the same run
             st.stop()
 
-        # Persist only on final decision (after contact form step)
-        if is_final_decision(raw_reply):
-            st.session_state.intake_complete = True
-            ok, msg = persist_result(
-                reply_text=raw_reply,
-                session_id=st.session_state.get("_session_id")
-            )
-            if ok:
-                st.toast("✅ Saved final decision + consent + answers to Supabase.")
-            else:
-                st.caption(f"Note: {msg}")
-
-        display_reply = strip_machine_json(raw_reply)
-        if display_reply:
-            st.session_state.messages.append({"role": "assistant", "content": display_reply})
-
 # One last nudge to keep the view pinned to the bottom after any action
 scroll_to_bottom()
 
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: contact-intent classifier vs the old keyword trigger.
+
+Both are scored on the held-out replies in data/contact_intent/eval.jsonl. They are never
+used for training, threshold calibration or tuning, and are worded apart from the training
+set: no eval reply shares half its words (Jaccard >= MAX_OVERLAP) with a training reply.
+The overlap is re-checked on every run.
+Reports precision / recall / F1 and scoring latency (whole reply, and per streamed delta).
+
+Usage:
+  python bench_contact_intent.py [--repeats 200]
+"""
+
+import re
+import time
+import argparse
+
+from contact_intent import _WORD, DATA_DIR, IntentScorer, load_examples, load_model
+
+MAX_OVERLAP = 0.5
+
+def keyword_trigger(text: str) -> bool:
+    """
+    The regex heuristics should_trigger_contact_form used before the classifier.
+    """
+    if re.search(r"\b(email|e-mail)\b", text or "", re.I) and re.search(r"\b(phone|number)\b", text or "", re.I):
+        return True
+    if re.search(r"\bconsent\b", text or "", re.I) and re.search(r"\bcontact(ed)?\b", text or "", re.I):
+        return True
+    return False
+
+def classifier_trigger(text: str) -> bool:
+    scorer = IntentScorer()
+    scorer.feed(text)
+    scorer.finish()
+    return scorer.triggered
+
+def max_overlap(texts, train_texts):
+    """
+    (highest word-set Jaccard of any eval reply with any training reply, eval reply)
+    """
+    train_words = [set(_WORD.findall(t.lower())) for t in train_texts]
+    best = (0.0, None)
+    for t in texts:
+        a = set(_WORD.findall(t.lower()))
+        for b in train_words:
+            j = len(a & b) / len(a | b) if a | b else 0.0
+            if j > best[0]:
+                best = (j, t)
+    return best
+
+def prf(preds, labels):
+    tp = sum(1 for p, y in zip(preds, labels) if p and y)
+    fp = sum(1 for p, y in zip(preds, labels) if p and not y)
+    fn = sum(1 for p, y in zip(preds, labels) if not p and y)
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1, fp, fn
+
+def deltas(text: str) -> list:
+    # roughly token-sized pieces, like a chat-completions stream
+    return re.findall(r"\s*\w{1,4}|\s*[^\w\s]|\s+", text)
+
+def time_per_call_us(fn, items, repeats: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for item in items:
+            fn(item)
+    return (time.perf_counter() - t0) / (repeats * len(items)) * 1e6
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--repeats", type=int, default=200)
+    args = ap.parse_args(argv)
+
+    texts, y = load_examples(DATA_DIR / "eval.jsonl")
+    labels = [bool(v) for v in y]
+    load_model()  # keep the one-off file read out of the timings
+
+    overlap, closest = max_overlap(texts, load_examples(DATA_DIR / "train.jsonl")[0])
+    if overlap >= MAX_OVERLAP:
+        raise SystemExit(f"eval overlaps train (Jaccard {overlap:.2f}): {closest!r}")
+
+    print(f"eval set: {len(texts)} replies ({sum(labels)} hand-offs), threshold {load_model()[2]:.2f}, "
+          f"max train overlap {overlap:.2f}")
+    for name, fn in (("keyword regex", keyword_trigger), ("classifier", classifier_trigger)):
+        p, r, f1, fp, fn_ = prf([fn(t) for t in texts], labels)
+        us = time_per_call_us(fn, texts, args.repeats)
+        print(f"  {name:<14} precision {p:.3f}  recall {r:.3f}  F1 {f1:.3f}  "
+              f"(FP {fp}, FN {fn_})  {us:.1f} us/reply")
+
+    streamed = [deltas(t) for t in texts]
+    n_deltas = sum(len(d) for d in streamed)
+
+    def stream_score(pieces):
+        scorer = IntentScorer()
+        for piece in pieces:
+            scorer.feed(piece)
+        return scorer.finish()
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeats):
+        for pieces in streamed:
+            stream_score(pieces)
+    per_delta_us = (time.perf_counter() - t0) / (args.repeats * n_deltas) * 1e6
+    print(f"  incremental    {per_delta_us:.2f} us/delta over {n_deltas} deltas")
+
+if __name__ == "__main__":
+    main()
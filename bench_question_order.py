@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Simulation benchmark: mean questions-to-decision for different interview orders.
+
+Synthetic patients fail each preset criterion independently with a fixed rate.
+An interview runs like the app's: age is asked in the greeting, then one plan criterion per
+question, stopping at the first disqualifier or after --max-questions plan questions (the
+system prompt's "top 3-5 only"). A patient whose disqualifier was never reached is passed as
+Likely Eligible, which the "missed knock-outs" column counts.
+
+History is closed-loop: sessions are run in rounds, each round following the plan the
+stats produced so far, so the estimator only ever sees data its own plan generated.
+Persisted rows look like the app's: model-worded questions, answer keys, and
+rationales that cite criteria by number, by negation ("No exclusion criteria apply")
+or only by topic ("which is an exclusion"); a share of rows also carry the structured
+parsed_rules statuses the system prompt asks for ("unknown" for criteria never reached).
+
+Compared estimators:
+- exposure (FailureStats): failures / sessions that screened the criterion
+- per-session: failures / all decided sessions (the first version of FailureStats)
+
+Usage:
+  python bench_question_order.py [--population asthma|late-knockout] [--history 5000]
+                                 [--rounds 20] [--structured 0.5] [--max-questions 5] [--seed 7]
+"""
+
+import random
+import argparse
+
+from prescreen_core import PRESET_CRITERIA, criterion_labels
+from question_order import FailureStats, interview_order
+
+ASKED_IN_GREETING = ("inclusion 1",)  # as in the app
+MAX_QUESTIONS = 5                    # plan questions per interview ("Take the top 3-5 only")
+
+# Rough per-criterion knock-out rates for a routine-care asthma population
+TRUE_FAIL_RATE = {
+    "inclusion 1": 0.05,  # adult
+    "inclusion 2": 0.10,  # asthma visit in 12 months
+    "inclusion 3": 0.30,  # SABA-only fill
+    "inclusion 4": 0.45,  # exacerbation in 12 months
+    "inclusion 5": 0.12,  # continuous insurance
+    "inclusion 6": 0.08,  # willingness / physician sign-off
+    "exclusion 1": 0.07,  # COPD and other major respiratory disease
+    "exclusion 2": 0.04,  # recent ED / systemic steroid
+    "exclusion 3": 0.06,  # chronic OCS
+    "exclusion 4": 0.03,  # prior albuterol-budesonide rescue
+    "exclusion 5": 0.02,  # malignancy
+    "exclusion 6": 0.03,  # pregnant / breastfeeding
+}
+
+# --population late-knockout: the commonest disqualifier is listed last, behind several
+# moderate ones, so a plan that starts in listed order rarely reaches it
+LATE_KNOCKOUT = {f"inclusion {i}": 0.30 for i in range(1, 6)}
+LATE_KNOCKOUT["exclusion 6"] = 0.50
+
+# How the model tends to word each question, and the answers key it files it under
+QUESTIONS = {
+    "inclusion 1": ("How old are you?", "age"),
+    "inclusion 2": ("Have you seen a doctor for your asthma in the past year?", "asthma_visit_12mo"),
+    "inclusion 3": ("Do you use only an albuterol rescue inhaler, filled in the past 12 months?", "saba_only"),
+    "inclusion 4": ("Have you had an asthma flare-up in the past year that needed extra treatment?", "flare_up_12mo"),
+    "inclusion 5": ("Have you had medical and pharmacy insurance for the whole past year?", "insurance_12mo"),
+    "inclusion 6": ("Would you answer quarterly safety questions and surveys by email or text?", "willing_surveys"),
+    "exclusion 1": ("Have you been diagnosed with COPD or another major lung condition?", "lung_disease"),
+    "exclusion 2": ("In the last 10 days, have you had an ER or urgent care visit for asthma?", "recent_er"),
+    "exclusion 3": ("Have you taken oral steroids daily for 2+ weeks in the last 3 months?", "chronic_ocs"),
+    "exclusion 4": ("Have you used an albuterol-budesonide combination rescue inhaler before?", "combo_rescue"),
+    "exclusion 5": ("Any cancer diagnosis in the past year, other than skin cancer?", "malignancy"),
+    "exclusion 6": ("Are you currently pregnant or breastfeeding?", "pregnant"),
+}
+
+TOPIC = {
+    "exclusion 1": "a COPD diagnosis", "exclusion 2": "an urgent care visit 4 days ago",
+    "exclusion 3": "daily oral corticosteroids", "exclusion 4": "prior combination rescue use",
+    "exclusion 5": "a malignancy treated this year", "exclusion 6": "being pregnant",
+}
+
+def rationale_for(failed: str, passed: list, rng) -> str:
+    kind, num = failed.split()
+    met = ", ".join(p.split()[1] for p in passed if p.startswith("inclusion")) or "1"
+    if kind == "inclusion":
+        return rng.choice([
+            f"Inclusion {num} not met. No exclusion criteria (exclusion 1-6) apply.",
+            f"Meets inclusion {met} but fails inclusion {num}. Exclusion 2 does not apply.",
+            f"Does not meet inclusion criterion {num}; no exclusions identified.",
+        ])
+    return rng.choice([
+        f"Meets inclusion {met}; exclusion criterion #{num} applies.",
+        f"Patient reports {TOPIC[failed]}, which is an exclusion.",
+        f"Exclusion {num} met ({TOPIC[failed]}). Inclusion criteria otherwise not contradicted.",
+    ])
+
+def simulate_patient(rng) -> set:
+    return {label for label, p in TRUE_FAIL_RATE.items() if rng.random() < p}
+
+def run_interview(order: list, fails: set, max_questions: int = MAX_QUESTIONS):
+    """
+    (criteria asked, first failed criterion or None): the greeting, then the plan up to the cap.
+    """
+    asked = []
+    for label in list(ASKED_IN_GREETING) + order[:max_questions]:
+        asked.append(label)
+        if label in fails:
+            return asked, label
+    return asked, None
+
+def persisted_row(asked: list, failed: str, structured: bool, rng) -> dict:
+    row = {
+        "asked_questions": [QUESTIONS[c][0] for c in asked],
+        "answers": {QUESTIONS[c][1]: c != failed for c in asked},
+    }
+    if failed:
+        row["decision"] = "Likely Ineligible"
+        row["rationale"] = rationale_for(failed, [c for c in asked if c != failed], rng)
+    else:
+        row["decision"] = "Likely Eligible"
+        row["rationale"] = "All key inclusion criteria met; no exclusion criteria apply."
+    if structured:
+        row["parsed_rules"] = {"criteria": [
+            {"id": c, "status": "unknown" if c not in asked
+             else "met" if (c == failed) == c.startswith("exclusion") else "not_met"}
+            for c, _ in criterion_labels(PRESET_CRITERIA)
+        ]}
+    return row
+
+class PerSessionStats(FailureStats):
+    # the original estimator: no exposure, every decided session in the denominator
+    def failure_rate(self, label: str) -> float:
+        return (self.failures.get(label, 0) + 1) / (self.sessions + 2)
+
+def fit_closed_loop(stats: FailureStats, sessions: int, rounds: int, structured: float,
+                    max_questions: int, rng) -> FailureStats:
+    per_round = max(1, sessions // rounds)
+    for _ in range(rounds):
+        order = interview_order(PRESET_CRITERIA, stats, skip=ASKED_IN_GREETING)
+        for _ in range(per_round):
+            asked, failed = run_interview(order, simulate_patient(rng), max_questions)
+            stats.update_rows([persisted_row(asked, failed, rng.random() < structured, rng)])
+    return stats
+
+def evaluate(order_fn, patients: list, max_questions: int, rng) -> tuple:
+    """
+    (mean questions-to-decision, share of ineligible patients passed as Likely Eligible)
+    """
+    questions = missed = ineligible = 0
+    for fails in patients:
+        asked, failed = run_interview(order_fn(rng), fails, max_questions)
+        questions += len(asked)
+        if fails:
+            ineligible += 1
+            missed += failed is None
+    return questions / len(patients), missed / ineligible if ineligible else 0.0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--population", choices=["asthma", "late-knockout"], default="asthma")
+    ap.add_argument("--history", type=int, default=5000, help="simulated past sessions to learn from")
+    ap.add_argument("--rounds", type=int, default=20, help="plan refreshes across the history")
+    ap.add_argument("--structured", type=float, default=0.5, help="share of rows with parsed_rules statuses")
+    ap.add_argument("--max-questions", type=int, default=MAX_QUESTIONS, help="plan questions per interview")
+    ap.add_argument("--patients", type=int, default=20000, help="simulated patients to interview")
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args(argv)
+
+    if args.population == "late-knockout":
+        TRUE_FAIL_RATE.update(LATE_KNOCKOUT)
+    rng = random.Random(args.seed)
+    fit = (args.history, args.rounds, args.structured, args.max_questions, rng)
+    exposure = fit_closed_loop(FailureStats(), *fit)
+    per_session = fit_closed_loop(PerSessionStats(), *fit)
+    patients = [simulate_patient(rng) for _ in range(args.patients)]
+
+    listed = [label for label in TRUE_FAIL_RATE if label not in ASKED_IN_GREETING]
+    orders = {
+        "exposure (FailureStats)": interview_order(PRESET_CRITERIA, exposure, skip=ASKED_IN_GREETING),
+        "per-session rate": interview_order(PRESET_CRITERIA, per_session, skip=ASKED_IN_GREETING),
+        "oracle (true rates)": sorted(listed, key=lambda label: -TRUE_FAIL_RATE[label]),
+    }
+
+    def shuffled(r):
+        order = listed[:]
+        r.shuffle(order)
+        return order
+
+    print(f"population={args.population} history={args.history} rounds={args.rounds} structured={args.structured} "
+          f"max_questions={args.max_questions} patients={args.patients} seed={args.seed}")
+    for name, order in orders.items():
+        print(f"  {name:<24} order: {', '.join(order)}")
+    results = [("listed order", lambda r: listed), ("model's choice (random)", shuffled)]
+    results += [(name, (lambda o: lambda r: o)(order)) for name, order in orders.items()]
+    for name, fn in results:
+        q, missed = evaluate(fn, patients, args.max_questions, rng)
+        print(f"  {name:<24} mean questions-to-decision: {q:.3f}  missed knock-outs: {missed:.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+TrialMatch contact-intent classifier (is this reply handing off to the contact form?)
+- Hashed word unigram + bigram presence features, logistic regression in NumPy
+- IntentScorer scores incrementally as stream deltas arrive; machine JSON is ignored
+- Threshold calibrated on out-of-fold predictions (best F1) and shipped with the weights
+
+Training data: data/contact_intent/train.jsonl ({"text", "label"}; 1 = hand-off).
+Weights:       data/contact_intent/model.npz (rebuild with `python contact_intent.py train`).
+"""
+
+import json
+import math
+import re
+import sys
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+DATA_DIR = Path(__file__).parent / "data" / "contact_intent"
+MODEL_PATH = DATA_DIR / "model.npz"
+DIM = 1 << 14
+
+_WORD = re.compile(r"[a-z0-9']+")
+_TAIL = re.compile(r"[A-Za-z0-9']+$|`{1,2}$")  # partial word / fence split across deltas
+_MACHINE_JSON = re.compile(r"```|\{")          # reply is past the human-readable part
+
+def _hash(feature: str) -> int:
+    # crc32, not hash(): str hashing is salted per process
+    return zlib.crc32(feature.encode("utf-8")) & (DIM - 1)
+
+def _features(words, prev=None):
+    for w in words:
+        yield _hash("w:" + w)
+        if prev is not None:
+            yield _hash(f"b:{prev} {w}")
+        prev = w
+
+def featurize(text: str) -> list:
+    """
+    Sorted hashed feature ids for a whole reply (training / offline use).
+    """
+    m = _MACHINE_JSON.search(text)
+    visible = text[:m.start()] if m else text
+    return sorted(set(_features(_WORD.findall(visible.lower()))))
+
+# =========================
+# 1) MODEL
+# =========================
+_model = None
+
+def load_model(path=MODEL_PATH):
+    """
+    (weights, bias, threshold), loaded once per process.
+    """
+    global _model
+    if _model is None:
+        with np.load(path) as z:
+            _model = (z["weights"].astype(np.float64), float(z["bias"]), float(z["threshold"]))
+    return _model
+
+class IntentScorer:
+    """
+    Feed stream deltas; .probability is P(hand-off) over the words seen so far.
+    Each feature is added once, so a delta costs only its own new words.
+    """
+
+    def __init__(self, model=None):
+        self.weights, self.bias, self.threshold = model or load_model()
+        self._seen = set()
+        self._logit = self.bias
+        self._tail = ""
+        self._prev = None
+        self._done = False
+
+    def _add(self, chunk: str):
+        words = _WORD.findall(chunk.lower())
+        for f in _features(words, self._prev):
+            if f not in self._seen:
+                self._seen.add(f)
+                self._logit += self.weights[f]
+        if words:
+            self._prev = words[-1]
+
+    def feed(self, delta: str) -> float:
+        if self._done or not delta:
+            return self.probability
+        buf = self._tail + delta
+        m = _MACHINE_JSON.search(buf)
+        if m:
+            buf, self._done = buf[:m.start()], True
+            self._tail = ""
+        else:
+            t = _TAIL.search(buf)
+            self._tail = t.group() if t else ""
+            buf = buf[:t.start()] if t else buf
+        self._add(buf)
+        return self.probability
+
+    def finish(self) -> float:
+        """
+        Flush the trailing partial word at end of stream.
+        """
+        if self._tail and not self._done:
+            self._add(self._tail)
+        self._tail = ""
+        self._done = True
+        return self.probability
+
+    @property
+    def probability(self) -> float:
+        return 1.0 / (1.0 + math.exp(-self._logit))
+
+    @property
+    def triggered(self) -> bool:
+        return self.probability >= self.threshold
+
+def score_text(text: str) -> float:
+    scorer = IntentScorer()
+    scorer.feed(text or "")
+    return scorer.finish()
+
+# =========================
+# 2) TRAINING
+# =========================
+def load_examples(path) -> tuple:
+    texts, labels = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                texts.append(row["text"])
+                labels.append(int(row["label"]))
+    return texts, np.array(labels, dtype=np.float64)
+
+def _design(texts) -> np.ndarray:
+    X = np.zeros((len(texts), DIM), dtype=np.float64)
+    for i, t in enumerate(texts):
+        X[i, featurize(t)] = 1.0
+    return X
+
+def fit(X: np.ndarray, y: np.ndarray, l2: float = 1e-2, lr: float = 0.5, epochs: int = 400):
+    """
+    Full-batch gradient descent on L2-regularised log loss. Deterministic.
+    """
+    w = np.zeros(X.shape[1])
+    b = 0.0
+    n = len(y)
+    for _ in range(epochs):
+        p = 1.0 / (1.0 + np.exp(-(X @ w + b)))
+        g = p - y
+        w -= lr * (X.T @ g / n + l2 * w)
+        b -= lr * g.mean()
+    return w, b
+
+def calibrate_threshold(X: np.ndarray, y: np.ndarray, folds: int = 5) -> float:
+    """
+    Threshold with the best F1 on out-of-fold probabilities (ties go to the higher one,
+    since a false trigger costs a round trip).
+    """
+    idx = np.arange(len(y))
+    oof = np.zeros(len(y))
+    for k in range(folds):
+        test = idx % folds == k
+        w, b = fit(X[~test], y[~test])
+        oof[test] = 1.0 / (1.0 + np.exp(-(X[test] @ w + b)))
+
+    best_t, best_f1 = 0.5, -1.0
+    for t in np.round(np.arange(0.05, 0.96, 0.01), 2):
+        pred = oof >= t
+        tp = float(np.sum(pred & (y == 1)))
+        fp = float(np.sum(pred & (y == 0)))
+        fn = float(np.sum(~pred & (y == 1)))
+        f1 = 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+        if f1 >= best_f1:
+            best_t, best_f1 = float(t), f1
+    return best_t
+
+def train(data_path=DATA_DIR / "train.jsonl", out_path=MODEL_PATH):
+    texts, y = load_examples(data_path)
+    X = _design(texts)
+    threshold = calibrate_threshold(X, y)
+    w, b = fit(X, y)
+    np.savez_compressed(out_path, weights=w.astype(np.float32), bias=np.float64(b), threshold=np.float64(threshold))
+    print(f"trained on {len(y)} replies ({int(y.sum())} hand-offs), threshold {threshold:.2f} -> {out_path}")
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["train"]:
+        sys.exit("usage: python contact_intent.py train")
+    train()
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+TrialMatch funnel export (prescreen_contacts -> partitioned Parquet -> funnel rollups)
+- Pages through Supabase `prescreen_contacts` (or a local JSONL stand-in) in bulk chunks
+- Writes each chunk straight to Parquet, hive-partitioned by day, so memory stays bounded
+- Rolls up the funnel batch-by-batch with pyarrow.compute:
+  decision mix per trial, criterion most often behind ineligibility, questions per session
+- Contact fields (email/phone) are never exported
+
+Checks: python -m doctest funnel_export.py
+
+Usage:
+  python funnel_export.py export --out exports/funnel [--source rows.jsonl] [--chunk-size 5000] [--overwrite]
+  python funnel_export.py rollup --out exports/funnel [--batch-size 65536]
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from itertools import islice
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from prescreen_core import PRESET_CRITERIA, criterion_labels
+
+TABLE = "prescreen_contacts"
+KEY = "id"  # unique tie-breaker for keyset paging (rows can share a created_at)
+SOURCE_COLUMNS = "created_at,session_id,trial_title,decision,rationale,asked_questions,answers,parsed_rules,consent"
+
+SCHEMA = pa.schema([
+    ("created_at", pa.timestamp("us", tz="UTC")),
+    ("day", pa.string()),
+    ("session_id", pa.string()),
+    ("trial_title", pa.string()),
+    ("decision", pa.string()),
+    ("consent", pa.bool_()),
+    ("n_questions", pa.int32()),
+    ("n_answers", pa.int32()),
+    ("failed_criteria", pa.list_(pa.string())),
+    ("rationale", pa.string()),
+    ("asked_questions", pa.string()),  # raw JSON
+    ("answers", pa.string()),          # raw JSON
+    ("parsed_rules", pa.string()),     # raw JSON
+])
+
+UNKNOWN_TRIAL = "(unknown trial)"
+
+# =========================
+# 1) ROW -> RECORD
+# =========================
+_CRITERION_RE = re.compile(
+    r"\b(inclusion|exclusion)(?:\s+criteri(?:on|a))?\s*(?:#|no\.?\s*)?(\d{1,2})\b(?!\s*[-–]\s*\d)", re.I
+)
+_CLAUSE_SPLIT = re.compile(r"[.;!?\n…]+|\bbut\b|\bhowever\b|\bwhile\b", re.I)
+_NEGATION = re.compile(
+    r"\b(?:no|not|none|never|without|unmet|fails?|failed|ruled out)\b|n't\b", re.I
+)
+_WORDS = re.compile(r"[a-z][a-z0-9-]{3,}", re.I)
+_STOPWORDS = {
+    "with", "within", "before", "after", "date", "enrollment", "months", "month", "least",
+    "days", "visit", "use", "used", "have", "been", "from", "that", "this", "their", "each",
+    "following", "participants", "participant", "criteria", "criterion", "including", "e.g.",
+    "asthma", "history", "diagnosis", "diagnoses", "years", "year", "also", "need", "meet",
+    "above", "prior", "both", "without", "other", "condition", "conditions", "more", "than",
+    "were", "once", "post", "apply", "currently", "excluded", "study", "care", "eligible",
+    "inclusion", "information", "decision", "text", "email", "according", "states", "united",
+    "defined", "every", "longer", "except", "plans", "outcome", "major", "medical", "respond",
+    "participate", "approved", "instructed", "instruction", "filled", "primary", "secondary",
+}
+_MET = {"met", "applies", "apply", "yes", "true", "present", "excluded"}
+_NOT_MET = {"not_met", "not met", "unmet", "no", "false", "absent", "does_not_apply", "does not apply"}
+
+def _unique_terms(criteria: dict) -> dict:
+    """
+    label -> words that appear in that criterion's text and no other (e.g. "copd" -> exclusion 1).
+    """
+    words = {
+        label: {w.lower() for w in _WORDS.findall(text)} - _STOPWORDS
+        for label, text in criterion_labels(criteria)
+    }
+    seen = Counter(w for ws in words.values() for w in ws)
+    return {label: {w for w in ws if seen[w] == 1} for label, ws in words.items()}
+
+_TERMS = _unique_terms(PRESET_CRITERIA)
+
+def _mentioned(text: str, kind: str = None) -> list:
+    """
+    Criteria whose unique terms occur in text (optionally only inclusion / exclusion).
+    """
+    words = {w.lower() for w in _WORDS.findall(text or "")}
+    return [
+        label for label, terms in _TERMS.items()
+        if (kind is None or label.startswith(kind)) and words & terms
+    ]
+
+# How patient-facing questions and answer keys name the preset criteria, where that differs
+# from the criteria's clinical wording ("How old are you?" / "age" -> inclusion 1)
+_QUESTION_ALIASES = {
+    "inclusion 1": {"age", "old", "born", "birth", "adult"},
+    "inclusion 2": {"doctor", "clinician", "appointment", "checkup"},
+    "inclusion 4": {"flare", "flare-up", "flare-ups", "flares", "attack", "attacks", "exacerbations"},
+    "exclusion 4": {"budesonide", "albuterol-budesonide", "combination", "airsupra"},
+    "exclusion 6": {"pregnancy", "nursing"},
+}
+_ASKED_WORDS = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*|[a-z0-9]+")
+
+def _asked(asked_questions, answers) -> list:
+    """
+    Criteria the asked questions / answer keys point at (the criterion's own terms or an alias).
+    """
+    text = " ".join(str(q) for q in (_as_json_obj(asked_questions) or []))
+    answers = _as_json_obj(answers)
+    if isinstance(answers, dict):
+        text += " " + " ".join(str(k).replace("_", " ") for k in answers)
+    text = text.lower()
+    words = set(_ASKED_WORDS.findall(text)) | set(re.findall(r"[a-z0-9]+", text))
+    return [
+        label for label, terms in _TERMS.items()
+        if words & (terms | _QUESTION_ALIASES.get(label, set()))
+    ]
+
+def _label(kind: str, value) -> str:
+    m = re.search(r"(\d{1,2})", str(value))
+    return f"{kind} {int(m.group(1))}" if m else None
+
+def _structured_statuses(parsed_rules) -> dict:
+    """
+    label -> True (criterion met / exclusion applies) | False, from parsed_rules.
+    Reads parsed_rules["criteria"] = [{"id": "exclusion 3", "status": "met"}, ...] (the format the
+    system prompt asks for) and tolerates {"inclusion": [...], "exclusion": [...]} item lists.
+    """
+    rules = _as_json_obj(parsed_rules)
+    if not isinstance(rules, dict):
+        return {}
+    items = []
+    for c in rules.get("criteria") or []:
+        if isinstance(c, dict):
+            m = _CRITERION_RE.search(str(c.get("id") or c.get("label") or ""))
+            items.append((f"{m.group(1).lower()} {int(m.group(2))}" if m else None, c))
+    for kind in ("inclusion", "exclusion"):
+        for c in rules.get(kind) or []:
+            if isinstance(c, dict):
+                items.append((_label(kind, c.get("id", c.get("number", ""))), c))
+
+    out = {}
+    for label, c in items:
+        if not label:
+            continue
+        status = c.get("status", c.get("met", c.get("applies")))
+        if isinstance(status, bool):
+            out[label] = status
+        elif str(status).strip().lower() in _MET:
+            out[label] = True
+        elif str(status).strip().lower() in _NOT_MET:
+            out[label] = False
+    return out
+
+def _rationale_failures(rationale: str) -> list:
+    """
+    Failed criteria read from free text, clause by clause:
+    an exclusion counts unless its clause is negated ("Exclusion 2 does not apply"),
+    an inclusion counts only when negated ("Inclusion 4 not met").
+    Clauses that say "exclusion" without a number fall back to the criteria's own terms.
+    """
+    failed = []
+    for clause in _CLAUSE_SPLIT.split(rationale or ""):
+        negated = bool(_NEGATION.search(clause))
+        refs = [f"{k.lower()} {int(n)}" for k, n in _CRITERION_RE.findall(clause)]
+        if not refs and re.search(r"\bexclu(?:sion|ded|des)\b", clause, re.I) and not negated:
+            refs = _mentioned(clause, "exclusion")
+        for label in refs:
+            if label.startswith("exclusion") != negated and label not in failed:
+                failed.append(label)
+    return failed
+
+def criterion_outcomes(decision: str, rationale: str = None, asked_questions=None,
+                       answers=None, parsed_rules=None) -> tuple:
+    """
+    (assessed, failed) criterion labels for one persisted session.
+    Structured statuses in parsed_rules win; older rows fall back to the rationale text.
+    assessed is what the session actually screened (its exposure): criteria with an explicit
+    met / not-met status, criteria the questions / answer keys point at, and everything cited
+    as failing. An eligible decision adds nothing more: the interview stops after a few
+    questions, so criteria it never reached ("unknown") were not screened.
+
+    >>> sorted(criterion_outcomes("Likely Eligible", "All key criteria met.", ["How old are you?"],
+    ...        {"age": 40}, {"criteria": [{"id": "exclusion 6", "status": "unknown"}]})[0])
+    ['inclusion 1']
+    """
+    decision = (decision or "").lower()
+    statuses = _structured_statuses(parsed_rules)
+    if statuses:
+        failed = [
+            label for label, met in statuses.items()
+            if met == label.startswith("exclusion")
+        ] if "ineligible" in decision else []
+    else:
+        failed = _rationale_failures(rationale) if "ineligible" in decision else []
+    assessed = set(statuses) | set(_asked(asked_questions, answers)) | set(failed)
+    return assessed, failed
+
+def failed_criteria(decision: str, rationale: str = None, answers=None, parsed_rules=None) -> list:
+    """
+    Criterion labels ("exclusion 3", "inclusion 4") behind an ineligible decision.
+
+    >>> failed_criteria("Likely Ineligible", "Inclusion 4 not met: no exacerbation in 12 months. No exclusion criteria (exclusion 1-6) apply.")
+    ['inclusion 4']
+    >>> failed_criteria("Likely Ineligible", "Patient fails inclusion 4. Exclusion 2 does not apply.")
+    ['inclusion 4']
+    >>> failed_criteria("Likely Ineligible", "Patient has COPD, which is an exclusion.")
+    ['exclusion 1']
+    >>> failed_criteria("Likely Ineligible", "Meets inclusion 1; exclusion criterion #3 applies.")
+    ['exclusion 3']
+    >>> failed_criteria("Likely Ineligible", "Exclusion 2 applies.",
+    ...                 parsed_rules={"criteria": [{"id": "exclusion 2", "status": "not_met"},
+    ...                                            {"id": "inclusion 3", "status": "not_met"}]})
+    ['inclusion 3']
+    >>> failed_criteria("Likely Eligible", "Exclusion 1 applies.")
+    []
+    """
+    return criterion_outcomes(decision, rationale, None, answers, parsed_rules)[1]
+
+def _as_json_obj(value):
+    # jsonb comes back decoded from Supabase; the JSONL stand-in may hold strings
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+def _count(value) -> int:
+    value = _as_json_obj(value)
+    if isinstance(value, (list, dict)):
+        return len(value)
+    return 0
+
+def _parse_ts(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        ts = value
+    else:
+        ts = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc)
+
+def _dump(value):
+    value = _as_json_obj(value)
+    return None if value is None else json.dumps(value, ensure_ascii=False)
+
+def rows_to_table(rows: list) -> pa.Table:
+    """
+    Flatten one chunk of prescreen_contacts rows into an Arrow table (SCHEMA).
+    """
+    cols = {name: [] for name in SCHEMA.names}
+    for r in rows:
+        ts = _parse_ts(r.get("created_at"))
+        decision = r.get("decision") or "Unknown"
+        cols["created_at"].append(ts)
+        cols["day"].append(ts.date().isoformat() if ts else "unknown")
+        cols["session_id"].append(r.get("session_id"))
+        cols["trial_title"].append(r.get("trial_title") or UNKNOWN_TRIAL)
+        cols["decision"].append(decision)
+        cols["consent"].append(bool(r.get("consent")))
+        cols["n_questions"].append(_count(r.get("asked_questions")))
+        cols["n_answers"].append(_count(r.get("answers")))
+        cols["failed_criteria"].append(
+            failed_criteria(decision, r.get("rationale"), r.get("answers"), r.get("parsed_rules"))
+        )
+        cols["rationale"].append(r.get("rationale"))
+        cols["asked_questions"].append(_dump(r.get("asked_questions")))
+        cols["answers"].append(_dump(r.get("answers")))
+        cols["parsed_rules"].append(_dump(r.get("parsed_rules")))
+    return pa.Table.from_pydict(cols, schema=SCHEMA)
+
+# =========================
+# 2) SOURCES (chunked)
+# =========================
+def supabase_from_env():
+    from supabase import create_client
+    url = os.environ.get("SUPABASE_URL")
+    key = os.environ.get("SUPABASE_SERVICE_KEY")
+    if not (url and key):
+        raise SystemExit("Set SUPABASE_URL and SUPABASE_SERVICE_KEY, or pass --source rows.jsonl.")
+    return create_client(url, key)
+
+def iter_supabase_chunks(sb, chunk_size: int, columns: str = SOURCE_COLUMNS, newest_first: bool = False):
+    """
+    Keyset pagination on (created_at, id) (OFFSET gets slower the deeper it goes).
+    The id tie-breaker keeps rows that share a created_at from being skipped at a page boundary.
+    PostgREST may cap a page below chunk_size (max-rows), so only an empty page ends the scan.
+    """
+    if KEY not in columns.split(","):
+        columns += "," + KEY
+    op = "lt" if newest_first else "gt"
+    last = None
+    while True:
+        q = (sb.table(TABLE).select(columns)
+             .order("created_at", desc=newest_first).order(KEY, desc=newest_first)
+             .limit(chunk_size))
+        if last is not None:
+            ts, key = last
+            q = q.or_(f'created_at.{op}."{ts}",and(created_at.eq."{ts}",{KEY}.{op}.{key})')
+        rows = q.execute().data or []
+        if not rows:
+            return
+        yield rows
+        last = (rows[-1]["created_at"], rows[-1][KEY])
+
+def iter_jsonl_chunks(path: str, chunk_size: int):
+    """
+    Local stand-in: one prescreen_contacts row (as JSON) per line.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = (json.loads(line) for line in f if line.strip())
+        while True:
+            rows = list(islice(lines, chunk_size))
+            if not rows:
+                return
+            yield rows
+
+# =========================
+# 3) EXPORT
+# =========================
+def export(out_dir: str, chunks, overwrite: bool = False) -> int:
+    """
+    Write each chunk as its own set of Parquet files under out_dir/day=YYYY-MM-DD/.
+    Only one chunk is ever held in memory.
+    out_dir must be empty (or overwrite=True, which clears it first): parts left over from
+    an earlier, larger run would otherwise be counted by rollup().
+    """
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        if not overwrite:
+            raise FileExistsError(f"{out_dir} is not empty; pass --overwrite to replace the previous export")
+        shutil.rmtree(out_dir)
+    total = 0
+    for i, rows in enumerate(chunks):
+        table = rows_to_table(rows)
+        pq.write_to_dataset(
+            table,
+            root_path=out_dir,
+            partition_cols=["day"],
+            basename_template=f"part-{i:06d}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        total += table.num_rows
+        print(f"chunk {i}: {table.num_rows} rows (total {total})", file=sys.stderr)
+    return total
+
+# =========================
+# 4) ROLLUPS (batch-at-a-time)
+# =========================
+def rollup(out_dir: str, batch_size: int = 65536) -> dict:
+    """
+    Aggregate the exported dataset without loading it whole: each record batch is grouped
+    with pyarrow and folded into small per-group counters.
+    """
+    dataset = ds.dataset(out_dir, format="parquet", partitioning="hive", schema=SCHEMA)
+    columns = ["trial_title", "decision", "n_questions", "failed_criteria"]
+
+    decision_mix = Counter()      # (trial, decision) -> sessions
+    criterion_fails = Counter()   # (trial, criterion) -> ineligible sessions citing it
+    question_hist = Counter()     # n_questions -> sessions
+    sessions = 0
+
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        t = pa.Table.from_batches([batch])
+        sessions += t.num_rows
+
+        mix = t.group_by(["trial_title", "decision"]).aggregate([("decision", "count")])
+        for trial, decision, n in zip(*(mix.column(c).to_pylist() for c in ("trial_title", "decision", "decision_count"))):
+            decision_mix[(trial, decision)] += n
+
+        hist = pc.value_counts(t.column("n_questions")).flatten()
+        for q, n in zip(hist[0].to_pylist(), hist[1].to_pylist()):
+            question_hist[q] += n
+
+        fc = t.column("failed_criteria").combine_chunks()
+        flat = pc.list_flatten(fc)
+        if len(flat):
+            owners = pc.take(t.column("trial_title"), pc.list_parent_indices(fc))
+            crit = pa.table({"trial_title": owners, "criterion": flat})
+            agg = crit.group_by(["trial_title", "criterion"]).aggregate([("criterion", "count")])
+            for trial, c, n in zip(*(agg.column(k).to_pylist() for k in ("trial_title", "criterion", "criterion_count"))):
+                criterion_fails[(trial, c)] += n
+
+    trials = defaultdict(lambda: {"sessions": 0, "decisions": {}, "top_ineligibility_criterion": None, "ineligibility_criteria": {}})
+    for (trial, decision), n in sorted(decision_mix.items()):
+        trials[trial]["sessions"] += n
+        trials[trial]["decisions"][decision] = n
+    for (trial, c), n in sorted(criterion_fails.items(), key=lambda kv: -kv[1]):
+        trials[trial]["ineligibility_criteria"][c] = n
+        if trials[trial]["top_ineligibility_criterion"] is None:
+            trials[trial]["top_ineligibility_criterion"] = c
+
+    total_q = sum(q * n for q, n in question_hist.items())
+    return {
+        "sessions": sessions,
+        "questions_per_session": {
+            "mean": round(total_q / sessions, 3) if sessions else None,
+            "histogram": {str(q): question_hist[q] for q in sorted(question_hist)},
+        },
+        "trials": dict(trials),
+    }
+
+# =========================
+# 5) CLI
+# =========================
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Export and roll up the prescreen funnel.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    ex = sub.add_parser("export", help="page prescreen_contacts into partitioned Parquet")
+    ex.add_argument("--out", required=True, help="output dataset directory")
+    ex.add_argument("--source", help="local JSONL stand-in instead of Supabase")
+    ex.add_argument("--chunk-size", type=int, default=5000)
+    ex.add_argument("--overwrite", action="store_true", help="clear a non-empty --out first")
+
+    ru = sub.add_parser("rollup", help="compute funnel rollups from an exported dataset")
+    ru.add_argument("--out", required=True, help="exported dataset directory")
+    ru.add_argument("--batch-size", type=int, default=65536)
+
+    args = ap.parse_args(argv)
+    if args.cmd == "export":
+        chunks = (iter_jsonl_chunks(args.source, args.chunk_size) if args.source
+                  else iter_supabase_chunks(supabase_from_env(), args.chunk_size))
+        try:
+            n = export(args.out, chunks, overwrite=args.overwrite)
+        except FileExistsError as e:
+            raise SystemExit(str(e))
+        print(f"Exported {n} rows to {args.out}", file=sys.stderr)
+    else:
+        print(json.dumps(rollup(args.out, args.batch_size), indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+TrialMatch pre-screen core (no Streamlit)
+- Parsing of assistant replies: machine JSON, decision, contact-form trigger
+- Result payload for prescreen_contacts
+- Stream draining shared by the app and the replay suite (replay.py)
+"""
+
+import re
+import json
+from datetime import datetime, timezone
+
+from contact_intent import IntentScorer
+
+CONTACT_TOKEN = "[CONTACT_INFO_FORM]"  # sentinel the model outputs to trigger the form
+FORM_FALLBACK = "Great—you're likely a fit. Please complete the short contact form below."
+
+PRESET_CRITERIA = {
+    "title": "Combination Short-Acting BroNchodilator and Inhaled Corticosteroid Rescue Therapy on Health Outcomes in Routine Care | NCT06422689",
+    "inclusion": [
+        "1. Adults aged 18 years and above as of enrollment date.",
+	"2. At least 1 visit with primary or secondary diagnosis of asthma on or within 12 months prior to the enrollment date.",
+	"3. At least 1 prescription filled for Short-acting beta-agonist (SABA)-only inhaler (i.e., albuterol-only or levalbuterol only inhalers) within 12 months before enrollment date.",
+	"4. At least 1 asthma exacerbation within 12 months before enrollment date.",
+	"5. Had both medical and pharmacy insurance coverage (e.g., Medicare, Medicaid, and commercial insurance) for at least 12 months before enrollment date and without foreseeable plans to discontinue insurance coverage within 12 months after enrollment date.",
+	"6. Participants also need to meet each of the following inclusion criteria: 1. Willingness to use albuterol and budesonide as rescue as instructed by their physician, prescribing information, and United States instruction for use (USIFU). 2. Willingness to respond to quarterly safety inquiries. 3. Willingness to participate in quarterly electronic patient-reported outcome (PRO) surveys via email or text. 4. Physician decision that participant is eligible for treatment with albuterol and budesonide as rescue according to the approved United States prescribing information (USPI)."
+    ],
+    "exclusion": [
+        "1. Conditions with major respiratory diagnoses including chronic obstructive pulmonary disease (COPD), cystic fibrosis, pulmonary fibrosis, bronchiectasis, respiratory tract cancer, bronchopulmonary dysplasia, sarcoidosis, lung cancer, interstitial lung disease, pulmonary hypertension, and tuberculosis in 12 months before the enrollment date.",
+	"2. Inpatient admission or emergency department or urgent care visit due to asthma in the 10 days before enrollment date, or self-reported use of systemic corticosteroid for the treatment of asthma in the 10 days before enrollment date. Participants who were screen-failed due to this criterion may be re-screened once the participant is more than 10 days post asthma-related inpatient admission, emergency department or urgent care visit, or systemic corticosteroid use.",
+	"3. Chronic use of oral corticosteroids (for any condition) within 3 months before enrollment date. Chronic use of oral corticosteroids is defined as: daily or every other day use for 14 days or longer.",
+	"4. History of albuterol and budesonide as rescue use within 12 months before enrollment date.",
+	"5. History of any malignancy (except non-melanoma neoplasms of skin) in 12 months before the enrollment date.",
+	"6. For females only - currently pregnant or breastfeeding on enrollment date. Participants are excluded from the study if any of the following criteria apply."
+    ],
+}
+
+def criterion_labels(criteria: dict) -> list:
+    """
+    [(label, text)] in the order the criteria are listed, e.g. ("exclusion 3", "Chronic use of ...").
+    Labels follow the "N." numbering of the preset lists, which is what rationales cite.
+    """
+    out = []
+    for kind in ("inclusion", "exclusion"):
+        for i, item in enumerate(criteria.get(kind, []), start=1):
+            m = re.match(r"\s*(\d+)\.\s*(.*)", item, re.S)
+            num, text = (int(m.group(1)), m.group(2)) if m else (i, item)
+            out.append((f"{kind} {num}", text.strip()))
+    return out
+
+def _as_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if isinstance(value, str):
+        return value.strip().lower() in {"yes", "y", "true", "t", "1", "consent", "agree", "agreed"}
+    return False
+
+def _normalize_decision(s: str) -> str:
+    s = (s or "").strip().lower()
+    if "likely ineligible" in s or "ineligible" in s:
+        return "Likely Ineligible"
+    if "likely eligible" in s:
+        return "Likely Eligible"
+    if s == "eligible" or ("eligible" in s and "likely" not in s and "ineligible" not in s):
+        return "Eligible"
+    if "unknown" in s:
+        return "Unknown"
+    return "Unknown"
+
+def extract_last_json_block(text: str):
+    """
+    Parse the last JSON object from assistant reply.
+    Supports ```json ...``` fenced or raw {...}.
+    """
+    try:
+        blocks = re.findall(r"```(?:json)?\s*({[\s\S]*?})\s*```", text)
+        candidate = blocks[-1] if blocks else re.findall(r"({[\s\S]*})", text)[-1]
+        return json.loads(candidate)
+    except Exception:
+        return None
+
+def strip_machine_json(text: str) -> str:
+    """
+    Hide machine JSON & the contact token from user-visible content.
+    """
+    t = re.sub(r"```(?:json)?\s*{[\s\S]*?}\s*```", "", text).strip()
+    t = re.sub(r"\s*{[\s\S]*}\s*$", "", t).strip()
+    t = t.replace(CONTACT_TOKEN, "").strip()
+    return t
+
+def build_result_payload(reply_text: str, session_id: str = None) -> dict:
+    """
+    prescreen_contacts row for a reply (any decision).
+    Fields: created_at, trial_title, decision, rationale, asked_questions, answers,
+            parsed_rules, contact_email, contact_phone, consent, session_id
+    """
+    data = extract_last_json_block(reply_text)
+
+    decision = "Unknown"
+    rationale = "No JSON payload found."
+    answers = None
+    parsed_rules = None
+    contact = {}
+    trial_title = None
+    questions = None
+
+    if data:
+        decision = _normalize_decision(data.get("decision"))
+        rationale = data.get("rationale")
+        answers = data.get("answers")
+        parsed_rules = data.get("parsed_rules")
+        contact = data.get("contact_info") or {}
+        trial_title = (parsed_rules or {}).get("trial_title")
+        questions = data.get("asked_questions")
+
+    consent_val = _as_bool(contact.get("consent"))
+    contact_email = contact.get("email")
+    contact_phone = contact.get("phone")
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "trial_title": trial_title,
+        "decision": decision,
+        "rationale": rationale,
+        "asked_questions": questions,
+        "answers": answers,
+        "parsed_rules": parsed_rules,
+        "contact_email": contact_email,
+        "contact_phone": contact_phone,
+        "consent": consent_val,
+        "session_id": session_id,
+    }
+
+def is_final_decision(reply_text: str) -> bool:
+    data = extract_last_json_block(reply_text)
+    return bool(isinstance(data, dict) and data.get("final") is True)
+
+def should_trigger_contact_form(text: str, intent: IntentScorer = None) -> bool:
+    """
+    Robust trigger: token OR the contact-intent classifier (paraphrased hand-offs).
+    Pass the IntentScorer fed during streaming to reuse its score.
+    """
+    if CONTACT_TOKEN in (text or ""):
+        return True
+    if intent is None:
+        intent = IntentScorer()
+        intent.feed(text or "")
+    intent.finish()
+    return intent.triggered
+
+def contact_form_message(contact: dict) -> str:
+    """
+    Hidden user turn that hands the submitted form to the model.
+    """
+    return (
+        "Here is my contact information from the form:\n"
+        f"Email: {contact['email']}\n"
+        f"Phone: {contact['phone']}\n"
+        f"Consent: {'true' if contact['consent'] else 'false'}"
+    )
+
+# Streamlit interrupts a run by raising these out of st.* calls (matched by name: this module
+# stays Streamlit-free, and their import path has moved between Streamlit releases)
+_CANCEL_EXCEPTIONS = {"StopException", "RerunException"}
+
+def _is_cancellation(exc: BaseException) -> bool:
+    return isinstance(exc, (GeneratorExit, KeyboardInterrupt)) or type(exc).__name__ in _CANCEL_EXCEPTIONS
+
+def consume_stream(stream, on_text=None, stop_on_contact: bool = False, on_done=None, intent=None):
+    """
+    Drain a chat-completions stream and return the raw reply text.
+    - on_text(text_so_far) after every content delta (the UI render hook)
+    - stop_on_contact: stop as soon as CONTACT_TOKEN appears
+    - intent: IntentScorer fed each delta, for should_trigger_contact_form()
+    - on_done(outcome, output_tokens, deltas) always runs, even when on_text raises; outcome is one of
+      completed | length_capped | stopped_on_contact_token | cancelled | errored.
+      cancelled is a Streamlit rerun / stop (or GeneratorExit); any other exception, e.g. an
+      API or network error mid-stream, is errored. The exception is re-raised either way.
+      output_tokens comes from the API usage chunk, so it is None for a stream cut short;
+      deltas counts the content chunks actually received.
+    The stream is closed on the way out so an abandoned generation stops.
+    """
+    chunks = []
+    outcome = "completed"
+    received = 0
+    usage = None
+    try:
+        for event in stream:
+            if getattr(event, "usage", None):
+                usage = event.usage.completion_tokens
+            if not event.choices:
+                continue
+            choice = event.choices[0]
+            delta = getattr(choice.delta, "content", None) or ""
+            if delta:
+                chunks.append(delta)
+                received += 1
+                if intent is not None:
+                    intent.feed(delta)
+                text = "".join(chunks)
+                if stop_on_contact and CONTACT_TOKEN in text:
+                    outcome = "stopped_on_contact_token"
+                    break
+                if on_text:
+                    on_text(text)
+            if choice.finish_reason:
+                outcome = "length_capped" if choice.finish_reason == "length" else "completed"
+    except BaseException as e:
+        outcome = "cancelled" if _is_cancellation(e) else "errored"
+        raise
+    finally:
+        stream.close()
+        if on_done:
+            on_done(outcome, usage, received)
+    return "".join(chunks)
+
+def handle_turn(raw_reply: str, phase: str, intent: IntentScorer = None, persist=None,
+                session_id: str = None) -> dict:
+    """
+    What a streamed reply does to the conversation (shared by the app and replay.py):
+    - interview turn that hands off -> show the contact form, with the model's text
+      (or FORM_FALLBACK) as the visible prompt
+    - otherwise, a final decision is built into a row and passed to persist(payload) -> (ok, msg)
+    Returns {"show_form", "visible", "payload", "saved"}; payload/saved are None when nothing was persisted.
+    """
+    turn = {"show_form": False, "visible": strip_machine_json(raw_reply), "payload": None, "saved": None}
+    if phase == "interview" and should_trigger_contact_form(raw_reply, intent):
+        turn["show_form"] = True
+        turn["visible"] = turn["visible"].strip() or FORM_FALLBACK
+    elif is_final_decision(raw_reply):
+        turn["payload"] = build_result_payload(raw_reply, session_id)
+        if persist:
+            turn["saved"] = persist(turn["payload"])
+    return turn
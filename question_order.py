@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+TrialMatch adaptive question ordering
+- Keeps per-criterion failure counts from persisted decisions (incrementally, one session at a time)
+- Orders the preset criteria so the most likely disqualifier is screened first
+- Renders that order as a fixed interview plan for the system prompt
+
+Asking the likeliest knock-out first minimises expected questions-to-decision,
+since the interview stops at the first disqualifier.
+"""
+
+import threading
+
+from funnel_export import criterion_outcomes
+from prescreen_core import criterion_labels
+
+_DECIDED = {"eligible", "likely eligible", "likely ineligible"}
+
+class FailureStats:
+    """
+    Running per-criterion failure counts over decided sessions.
+    The rate for a criterion is failures / sessions that actually screened it (its exposure),
+    so a criterion planned late - and so rarely reached - isn't mistaken for a rare disqualifier.
+    failure_rate() is Laplace-smoothed: unscreened criteria sit at 0.5, so they get asked
+    early enough to be measured, and cold start falls back to the listed order.
+    """
+
+    def __init__(self):
+        self.sessions = 0
+        self.exposures = {}
+        self.failures = {}
+        self.ready = False  # set once the persisted history has been folded in
+        self._lock = threading.Lock()  # shared across Streamlit sessions via cache_resource
+
+    def update(self, decision: str, rationale: str = None, asked_questions=None,
+               answers=None, parsed_rules=None):
+        if (decision or "").strip().lower() not in _DECIDED:
+            return  # Unknown says nothing about which criterion fails
+        assessed, failed = criterion_outcomes(decision, rationale, asked_questions, answers, parsed_rules)
+        with self._lock:
+            self.sessions += 1
+            for label in assessed:
+                self.exposures[label] = self.exposures.get(label, 0) + 1
+            for label in failed:
+                self.failures[label] = self.failures.get(label, 0) + 1
+
+    def update_rows(self, rows):
+        for r in rows:
+            self.update(r.get("decision"), r.get("rationale"), r.get("asked_questions"),
+                        r.get("answers"), r.get("parsed_rules"))
+
+    def load(self, chunks, max_rows: int = None):
+        """
+        Fold pages of persisted rows in (meant to run off the request path), then mark ready.
+        """
+        try:
+            n = 0
+            for rows in chunks:
+                self.update_rows(rows)
+                n += len(rows)
+                if max_rows and n >= max_rows:
+                    break
+        finally:
+            self.ready = True
+
+    def failure_rate(self, label: str) -> float:
+        return (self.failures.get(label, 0) + 1) / (self.exposures.get(label, 0) + 2)
+
+def interview_order(criteria: dict, stats: FailureStats, skip=()) -> list:
+    """
+    Criterion labels sorted by descending failure rate (stable, so ties keep the listed order).
+    """
+    labels = [label for label, _ in criterion_labels(criteria) if label not in skip]
+    return sorted(labels, key=lambda label: -stats.failure_rate(label))
+
+def plan_to_prompt(criteria: dict, order: list) -> str:
+    """
+    Numbered plan for the system prompt, one criterion per line.
+    """
+    text = dict(criterion_labels(criteria))
+    return "\n".join(
+        f"{i}. [{label}] {text[label][:160]}" for i, label in enumerate(order, start=1)
+    )
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+TrialMatch record/replay regression suite
+- RecordingStream wraps a live OpenAI stream and saves its chunks + timing to a fixture
+  (the app does this for every turn when TM_RECORD_DIR is set)
+- ReplayClient is a deterministic stand-in for client.chat.completions.create
+- run_conversation drives a fixture through the app's per-turn handling (prescreen_core.handle_turn):
+  contact trigger -> form -> final JSON -> persist to a fake store,
+  timing parse + render CPU per conversation
+- check compares against the expectations stored in each fixture, and the phase each turn
+  was recorded in against the phase the flow reaches it in; bless accepts the current results
+
+Fixture (fixtures/replays/<name>.json):
+  {"turns": [{"phase", "user", "finish", "chunks": [[dt_ms, delta], ...]}, ...],
+   "expect": {"contact_form_shown", "decisions", "visible", "rows", "cpu_budget_ms"}}
+
+Recordings hold whatever the model said, contact details included: record with test contacts only.
+
+Usage:
+  python replay.py check [fixture.json ...]   # exit 1 on any mismatch or CPU budget overrun
+  python replay.py bless [fixture.json ...]   # rewrite expectations from the current code
+"""
+
+import re
+import sys
+import json
+import math
+import time
+import argparse
+from pathlib import Path
+from types import SimpleNamespace
+
+from contact_intent import IntentScorer
+from prescreen_core import consume_stream, contact_form_message, handle_turn, strip_machine_json
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures" / "replays"
+DEFAULT_CPU_BUDGET_MS = 25.0  # for fixtures that were never blessed
+CPU_BUDGET_HEADROOM = 3.0     # bless sets the budget to this multiple of the measured time
+CPU_REPEATS = 5               # best-of, to keep scheduler noise out of the budget check
+TEST_CONTACT = {"email": "test.patient@example.com", "phone": "6175550100", "consent": True}
+
+# =========================
+# 1) FIXTURE FILES
+# =========================
+def load_fixture(path) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_fixture(path, fixture: dict):
+    text = json.dumps(fixture, indent=1, ensure_ascii=False)
+    # one [dt_ms, delta] pair per line instead of four
+    text = re.sub(r'\[\n\s+(-?[\d.]+),\n\s+("(?:[^"\\]|\\.)*")\n\s+\]', r"[\1, \2]", text)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text + "\n")
+
+# =========================
+# 2) RECORD
+# =========================
+class RecordingStream:
+    """
+    Pass-through over a live stream; on close() appends the turn to the fixture at `path`.
+    dt_ms is the gap before each delta (the first one is time-to-first-token).
+    """
+
+    def __init__(self, stream, path, phase: str, user: str = None):
+        self._stream = stream
+        self.path = Path(path)
+        self.phase = phase
+        self.user = user
+        self.chunks = []
+        self.finish = None
+
+    def __iter__(self):
+        last = time.perf_counter()
+        for event in self._stream:
+            if event.choices:
+                choice = event.choices[0]
+                delta = getattr(choice.delta, "content", None) or ""
+                if delta:
+                    now = time.perf_counter()
+                    self.chunks.append([round((now - last) * 1000, 1), delta])
+                    last = now
+                if choice.finish_reason:
+                    self.finish = choice.finish_reason
+            yield event
+
+    def close(self):
+        self._stream.close()
+        fixture = load_fixture(self.path) if self.path.exists() else {"turns": [], "expect": {}}
+        fixture["turns"].append({
+            "phase": self.phase,
+            "user": self.user,
+            "finish": self.finish,
+            "chunks": self.chunks,
+        })
+        save_fixture(self.path, fixture)
+
+# =========================
+# 3) REPLAY
+# =========================
+def _event(content=None, finish_reason=None):
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)], usage=None)
+
+class ReplayStream:
+    def __init__(self, turn: dict, realtime: bool = False):
+        self.turn = turn
+        self.realtime = realtime
+        self.closed = False
+
+    def __iter__(self):
+        for dt_ms, delta in self.turn["chunks"]:
+            if self.realtime:
+                time.sleep(dt_ms / 1000)
+            yield _event(delta)
+        yield _event(finish_reason=self.turn.get("finish") or "stop")
+        yield SimpleNamespace(choices=[], usage=SimpleNamespace(completion_tokens=len(self.turn["chunks"])))
+
+    def close(self):
+        self.closed = True
+
+class ReplayClient:
+    """
+    Quacks like OpenAI(): client.chat.completions.create(...) returns the next recorded turn.
+    """
+
+    def __init__(self, turns: list, realtime: bool = False):
+        self._turns = iter(turns)
+        self.realtime = realtime
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.requests.append(kwargs)
+        try:
+            turn = next(self._turns)
+        except StopIteration:
+            raise RuntimeError("replay fixture has no more recorded turns")
+        return ReplayStream(turn, self.realtime)
+
+class FakeStore:
+    """
+    Just enough of the Supabase client for sb.table(name).insert(payload).execute().
+    """
+
+    def __init__(self):
+        self.tables = {}
+
+    def table(self, name: str):
+        rows = self.tables.setdefault(name, [])
+        pending = []
+
+        class _Query:
+            def insert(self, payload):
+                pending.append(payload)
+                return self
+
+            def execute(self):
+                rows.extend(pending)
+                return SimpleNamespace(data=list(pending))
+
+        return _Query()
+
+def run_conversation(fixture: dict, name: str = None, realtime: bool = False) -> dict:
+    """
+    The app's chat / contact-form loop, one recorded turn per model call.
+    Returns what the suite asserts on, plus "phases" reached and "cpu_ms" spent parsing and rendering.
+    """
+    client = ReplayClient(fixture["turns"], realtime)
+    store = FakeStore()
+    out = {"phases": [], "contact_form_shown": False, "decisions": [], "visible": []}
+    awaiting_contact = False
+    cpu = 0.0
+
+    def persist(payload):
+        store.table("prescreen_contacts").insert(payload).execute()
+        return True, "Saved."
+
+    for _ in fixture["turns"]:
+        phase = "final" if awaiting_contact else "interview"
+        messages = [{"role": "user", "content": contact_form_message(TEST_CONTACT)}] if awaiting_contact else []
+        stream = client.chat.completions.create(model="replay", messages=messages, stream=True)
+
+        t0 = time.process_time()
+        intent = IntentScorer() if phase == "interview" else None
+        raw = consume_stream(
+            stream,
+            on_text=strip_machine_json,  # what the placeholder renders on every delta
+            stop_on_contact=(phase == "interview"),
+            intent=intent,
+        ).strip()
+        turn = handle_turn(raw, phase, intent, persist=persist, session_id=name)
+        cpu += time.process_time() - t0
+
+        awaiting_contact = turn["show_form"]
+        out["contact_form_shown"] |= turn["show_form"]
+        if turn["payload"] is not None:
+            out["decisions"].append(turn["payload"]["decision"])
+        out["phases"].append(phase)
+        out["visible"].append(turn["visible"])
+
+    out["rows"] = [
+        {k: v for k, v in row.items() if k != "created_at"}
+        for row in store.tables.get("prescreen_contacts", [])
+    ]
+    out["cpu_ms"] = round(cpu * 1000, 3)
+    return out
+
+def measure(fixture: dict, name: str = None) -> dict:
+    """
+    run_conversation, keeping the lowest CPU time over CPU_REPEATS runs.
+    """
+    runs = [run_conversation(fixture, name) for _ in range(CPU_REPEATS)]
+    best = runs[0]
+    best["cpu_ms"] = min(r["cpu_ms"] for r in runs)
+    return best
+
+# =========================
+# 4) CHECK / BLESS
+# =========================
+_ASSERTED = ("contact_form_shown", "decisions", "visible", "rows")
+
+def check(paths) -> int:
+    failures = 0
+    for path in paths:
+        fixture = load_fixture(path)
+        expect = fixture.get("expect") or {}
+        got = measure(fixture, Path(path).stem)
+        budget = expect.get("cpu_budget_ms", DEFAULT_CPU_BUDGET_MS)
+
+        problems = [f"{k}: expected {expect.get(k)!r}, got {got[k]!r}" for k in _ASSERTED if expect.get(k) != got[k]]
+        recorded = [t.get("phase") for t in fixture["turns"]]
+        if recorded != got["phases"]:
+            problems.append(f"phases: recorded {recorded!r}, replayed {got['phases']!r}")
+        if got["cpu_ms"] > budget:
+            problems.append(f"cpu {got['cpu_ms']:.3f} ms over budget {budget} ms")
+
+        if problems:
+            failures += 1
+            print(f"FAIL {Path(path).name}")
+            for p in problems:
+                print(f"  - {p}")
+        else:
+            print(f"ok   {Path(path).name}  ({got['cpu_ms']:.3f} ms cpu, budget {budget} ms)")
+    print(f"{len(paths) - failures}/{len(paths)} conversations passed")
+    return 1 if failures else 0
+
+def bless(paths) -> int:
+    failures = 0
+    for path in paths:
+        fixture = load_fixture(path)
+        got = measure(fixture, Path(path).stem)
+        recorded = [t.get("phase") for t in fixture["turns"]]
+        if recorded != got["phases"]:
+            # the recording and the flow disagree on when the form was shown: re-record, don't bless
+            failures += 1
+            print(f"SKIP {Path(path).name}  phases: recorded {recorded!r}, replayed {got['phases']!r}")
+            continue
+        budget = max(5.0, math.ceil(got["cpu_ms"] * CPU_BUDGET_HEADROOM / 5) * 5)
+        fixture["expect"] = {k: got[k] for k in _ASSERTED}
+        fixture["expect"]["cpu_budget_ms"] = budget
+        save_fixture(path, fixture)
+        print(f"blessed {Path(path).name}  ({got['cpu_ms']:.3f} ms cpu, budget {budget} ms)")
+    return 1 if failures else 0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Replay recorded conversations through the pre-screen flow.")
+    ap.add_argument("cmd", choices=["check", "bless"])
+    ap.add_argument("fixtures", nargs="*", help=f"fixture files (default: {FIXTURE_DIR}/*.json)")
+    args = ap.parse_args(argv)
+
+    paths = args.fixtures or sorted(str(p) for p in FIXTURE_DIR.glob("*.json"))
+    if not paths:
+        print(f"No fixtures found in {FIXTURE_DIR}")
+        return 1
+    return check(paths) if args.cmd == "check" else bless(paths)
+
+if __name__ == "__main__":
+    sys.exit(main())